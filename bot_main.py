@@ -1,17 +1,37 @@
-import json
 import os
 import asyncio
+import heapq
+import logging
+import signal
+import time
 from datetime import datetime
+from operator import itemgetter
+import orjson
+try:
+    import uvloop
+except ImportError:  # not available on Windows
+    uvloop = None
 from telegram import Update
 from telegram.ext import ApplicationBuilder, CommandHandler, ContextTypes
 
 DATA_DIR = "data"
 PLAYERS_FILE = os.path.join(DATA_DIR, "players.json")
+PLAYERS_LOG = os.path.join(DATA_DIR, "players.log")
 MARKET_FILE = os.path.join(DATA_DIR, "market.json")
 TOURN_FILE = os.path.join(DATA_DIR, "tournament.json")
 
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 
+# Set WEBHOOK_URL (public https base URL) to receive updates by webhook
+# instead of long polling. WEBHOOK_SECRET is required in that mode.
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+PORT = int(os.getenv("PORT", "8443"))
+
+logger = logging.getLogger(__name__)
+
+WELCOME_TEXT = "Welcome to CashPool RPG.\nUse /join, /play, /leaderboard"
+
 
 # ------------------------------
 # Data Helpers
@@ -20,84 +40,315 @@ def load_json(path, default):
     if not os.path.exists(path):
         return default
     try:
-        with open(path, "r") as f:
-            return json.load(f)
+        with open(path, "rb") as f:
+            return orjson.loads(f.read())
     except:
         return default
 
 
-def save_json(path, data):
-    with open(path, "w") as f:
-        json.dump(data, f, indent=2)
+def load_journal(path):
+    if not os.path.exists(path):
+        return []
+    records = []
+    torn = False
+    with open(path, "rb") as f:
+        for line in f:
+            try:
+                records.append(orjson.loads(line))
+            except ValueError:
+                torn = True
+    if torn:
+        # Drop blank or half-written lines left behind by a crash.
+        _atomic_write(path, b"".join(
+            orjson.dumps(r, option=orjson.OPT_APPEND_NEWLINE) for r in records
+        ))
+    return records
+
+
+def append_journal(path, data):
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        end = os.lseek(fd, 0, os.SEEK_END)
+        try:
+            view = memoryview(data)
+            while view:
+                view = view[os.write(fd, view):]
+        except BaseException:
+            # Cut off any partial write so the next append starts on a
+            # fresh line instead of being glued onto a torn one.
+            os.ftruncate(fd, end)
+            raise
+    finally:
+        os.close(fd)
+
+
+def _atomic_write(path, data):
+    tmp = f"{path}.tmp.{os.getpid()}"
+    with open(tmp, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def _write_snapshot(path, data, journal, pending):
+    # Journal the pending records first so that a crash at any point
+    # replays to the same state the snapshot holds.
+    if pending:
+        append_journal(journal, pending)
+    _atomic_write(path, data)
+    open(journal, "wb").close()
+
+
+# ------------------------------
+# In-memory State
+# ------------------------------
+class Store:
+    FLUSH_INTERVAL = 0.2
+    RETRY_INTERVAL = 5
+    SNAPSHOT_INTERVAL = 300
+    LEADERBOARD_TTL = 30
+
+    def __init__(self):
+        self.players = {}
+        self.tournament = {"tournaments": []}
+        self._tournament_mtime = None
+        self.leaderboard_cache = None  # (monotonic timestamp, rendered text)
+        self._changed = set()  # uids whose records are not journaled yet
+        self._journaled = False  # players.log holds records newer than players.json
+        self._snapshot_at = 0.0
+        # Created in load() so they bind to the running loop on Python 3.9.
+        self._flush_lock = None
+        self._wakeup = None
+        self._closing = None
+
+    def load(self):
+        self._flush_lock = asyncio.Lock()
+        self._wakeup = asyncio.Event()
+        self._closing = asyncio.Event()
+
+        os.makedirs(DATA_DIR, exist_ok=True)
+        self.players = load_json(PLAYERS_FILE, {})
+        records = load_journal(PLAYERS_LOG)
+        for r in records:
+            self.players[r["uid"]] = r["player"]
+        if records:
+            data = orjson.dumps(self.players, option=orjson.OPT_INDENT_2)
+            _write_snapshot(PLAYERS_FILE, data, PLAYERS_LOG, b"")
+        self._snapshot_at = time.monotonic()
+
+        self.tournaments()
+
+    def tournaments(self):
+        # tournament.json is hand-edited config; re-read it only when it changes.
+        try:
+            mtime = os.stat(TOURN_FILE).st_mtime_ns
+        except OSError:
+            mtime = None
+        if mtime != self._tournament_mtime:
+            if mtime is None:
+                self.tournament = {"tournaments": []}
+                self._tournament_mtime = None
+            else:
+                data = load_json(TOURN_FILE, None)
+                # On a parse error (e.g. a half-saved edit) keep the last good
+                # config and try again on the next call.
+                if data is not None:
+                    self.tournament = data
+                    self._tournament_mtime = mtime
+        return self.tournament["tournaments"]
+
+    def mark_player(self, uid):
+        self._changed.add(uid)
+        self._wakeup.set()
+
+    async def flush(self, snapshot=False):
+        async with self._flush_lock:
+            await self._flush(snapshot)
+
+    async def _flush(self, snapshot):
+        if not self._changed and not (snapshot and self._journaled):
+            return
+
+        changed, self._changed = self._changed, set()
+
+        # Serialize on the loop so what gets written is consistent,
+        # then hand the disk writes to a worker thread.
+        pending = b"".join(
+            orjson.dumps({"uid": uid, "player": self.players[uid]},
+                         option=orjson.OPT_APPEND_NEWLINE)
+            for uid in changed
+        )
+
+        now = time.monotonic()
+        try:
+            if snapshot or now - self._snapshot_at >= self.SNAPSHOT_INTERVAL:
+                data = orjson.dumps(self.players, option=orjson.OPT_INDENT_2)
+                await asyncio.to_thread(_write_snapshot, PLAYERS_FILE, data, PLAYERS_LOG, pending)
+                self._journaled = False
+                self._snapshot_at = now
+            else:
+                await asyncio.to_thread(append_journal, PLAYERS_LOG, pending)
+                self._journaled = True
+        except BaseException:
+            # Keep the batch for the next flush, and make that one a
+            # snapshot so the journal is compacted once writes succeed again.
+            self._changed |= changed
+            self._snapshot_at = float("-inf")
+            raise
+
+    async def _try_flush(self, snapshot=False):
+        try:
+            await self.flush(snapshot)
+        except Exception:
+            logger.exception("Failed to save player state")
+            return False
+        return True
+
+    async def _flush_loop(self):
+        while not self._closing.is_set():
+            await self._wakeup.wait()
+            # Give a burst of updates a moment to collapse into one write.
+            try:
+                await asyncio.wait_for(self._closing.wait(), self.FLUSH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            if not await self._try_flush():
+                # Retry later rather than spinning on e.g. a full disk.
+                self._wakeup.set()
+                try:
+                    await asyncio.wait_for(self._closing.wait(), self.RETRY_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+        await self._try_flush(snapshot=True)
+
+    def close(self):
+        self._closing.set()
+        self._wakeup.set()
+
+
+store = Store()
 
 
 # ------------------------------
 # Commands
 # ------------------------------
 async def start(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text("Welcome to CashPool RPG.\nUse /join, /play, /leaderboard")
+    await update.message.reply_text(WELCOME_TEXT)
 
 
 async def join(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
-    players = load_json(PLAYERS_FILE, {})
-    uid = str(update.effective_user.id)
+    players = store.players
+    user = update.effective_user
+    uid = str(user.id)
 
     if uid not in players:
         players[uid] = {
-            "name": update.effective_user.first_name,
+            "name": user.first_name,
             "wins": 0,
             "losses": 0,
             "credits": 0
         }
-        save_json(PLAYERS_FILE, players)
+        store.mark_player(uid)
+        store.leaderboard_cache = None
         await update.message.reply_text("You have joined the game!")
     else:
         await update.message.reply_text("You are already registered.")
 
 
 async def play(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
-    tourn = load_json(TOURN_FILE, {"tournaments": []})
+    tournaments = store.tournaments()
 
-    if not tourn["tournaments"]:
+    if not tournaments:
         await update.message.reply_text("No tournaments available right now.")
         return
 
-    t = tourn["tournaments"][0]  # only 1 for now
+    t = tournaments[0]  # only 1 for now
 
     label = f"{t['name']} – ${t['buy_in']} buy-in"
     await update.message.reply_text(f"Tournament available:\n{label}\nUse /join to enter.")
 
 
 async def leaderboard(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
-    players = load_json(PLAYERS_FILE, {})
+    players = store.players
 
     if not players:
         await update.message.reply_text("No players yet.")
         return
 
-    sorted_players = sorted(players.values(), key=lambda x: x["wins"], reverse=True)
+    cached = store.leaderboard_cache
+    if cached and time.monotonic() - cached[0] < store.LEADERBOARD_TTL:
+        await update.message.reply_text(cached[1])
+        return
 
-    text = "🏆 Leaderboard 🏆\n"
-    for p in sorted_players[:10]:
-        text += f"{p['name']}: {p['wins']} wins\n"
+    top_players = heapq.nlargest(10, players.values(), key=itemgetter("wins"))
 
+    text = "🏆 Leaderboard 🏆\n" + "".join([
+        f"{p['name']}: {p['wins']} wins\n" for p in top_players
+    ])
+
+    store.leaderboard_cache = (time.monotonic(), text)
     await update.message.reply_text(text)
 
 
 # ------------------------------
 # Main Bot Setup
 # ------------------------------
+COMMANDS = {
+    "start": start,
+    "join": join,
+    "play": play,
+    "leaderboard": leaderboard,
+}
+
+
 async def main():
-    app = ApplicationBuilder().token(BOT_TOKEN).build()
+    if WEBHOOK_URL and not WEBHOOK_SECRET:
+        raise SystemExit("WEBHOOK_SECRET must be set when WEBHOOK_URL is set")
+
+    store.load()
+    app = ApplicationBuilder().token(BOT_TOKEN).concurrent_updates(True).build()
 
-    app.add_handler(CommandHandler("start", start))
-    app.add_handler(CommandHandler("join", join))
-    app.add_handler(CommandHandler("play", play))
-    app.add_handler(CommandHandler("leaderboard", leaderboard))
+    for name, callback in COMMANDS.items():
+        app.add_handler(CommandHandler(name, callback))
 
     print("Bot is running...")
-    await app.run_polling()
+    async with app:
+        flusher = asyncio.create_task(store._flush_loop())
+        stop = asyncio.Event()
+        try:
+            # Handle Ctrl-C here too: on Python < 3.11 asyncio.run would
+            # otherwise cancel the flusher before its final snapshot.
+            for sig in (signal.SIGINT, signal.SIGTERM):
+                try:
+                    asyncio.get_running_loop().add_signal_handler(sig, stop.set)
+                except NotImplementedError:  # Windows
+                    pass
+
+            await app.start()
+            if WEBHOOK_URL:
+                await app.updater.start_webhook(
+                    listen="0.0.0.0",
+                    port=PORT,
+                    url_path="webhook",
+                    webhook_url=f"{WEBHOOK_URL.rstrip('/')}/webhook",
+                    secret_token=WEBHOOK_SECRET
+                )
+            else:
+                await app.updater.start_polling()
+            await stop.wait()
+        finally:
+            if app.updater.running:
+                await app.updater.stop()
+            if app.running:
+                await app.stop()
+            store.close()
+            await flusher
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    if uvloop is not None:
+        uvloop.run(main())
+    else:
+        asyncio.run(main())
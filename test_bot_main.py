@@ -0,0 +1,253 @@
+import asyncio
+import os
+
+import orjson
+import pytest
+
+import bot_main
+
+
+@pytest.fixture
+def data_dir(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs(bot_main.DATA_DIR)
+    return tmp_path / bot_main.DATA_DIR
+
+
+def new_store():
+    async def load():
+        store = bot_main.Store()
+        store.load()
+        return store
+    return asyncio.run(load())
+
+
+def write_journal(path, *records, tail=b""):
+    path.write_bytes(b"".join(orjson.dumps(r) + b"\n" for r in records) + tail)
+
+
+def read_players(data_dir):
+    return orjson.loads((data_dir / "players.json").read_bytes())
+
+
+def test_load_replays_journal_over_snapshot(data_dir):
+    (data_dir / "players.json").write_bytes(orjson.dumps({
+        "1": {"name": "a", "wins": 0},
+        "2": {"name": "b", "wins": 3},
+    }))
+    write_journal(
+        data_dir / "players.log",
+        {"uid": "1", "player": {"name": "a", "wins": 1}},
+        {"uid": "3", "player": {"name": "c", "wins": 0}},
+        {"uid": "1", "player": {"name": "a", "wins": 2}},
+    )
+
+    store = new_store()
+
+    expected = {
+        "1": {"name": "a", "wins": 2},
+        "2": {"name": "b", "wins": 3},
+        "3": {"name": "c", "wins": 0},
+    }
+    assert store.players == expected
+    # Startup compacts the replayed journal into a fresh snapshot.
+    assert read_players(data_dir) == expected
+    assert (data_dir / "players.log").read_bytes() == b""
+
+
+def test_load_drops_torn_trailing_line(data_dir):
+    write_journal(
+        data_dir / "players.log",
+        {"uid": "1", "player": {"name": "a", "wins": 1}},
+        tail=b'{"uid": "2", "pla',
+    )
+
+    store = new_store()
+
+    assert store.players == {"1": {"name": "a", "wins": 1}}
+    assert read_players(data_dir) == store.players
+
+
+def test_crash_between_snapshot_rename_and_truncate(data_dir, monkeypatch):
+    store = new_store()
+    store.players["1"] = {"name": "a", "wins": 0}
+    store.mark_player("1")
+    asyncio.run(store.flush())
+
+    store.players["1"]["wins"] = 5
+    store.players["2"] = {"name": "b", "wins": 1}
+    store.mark_player("1")
+    store.mark_player("2")
+    expected = orjson.loads(orjson.dumps(store.players))
+
+    real_atomic_write = bot_main._atomic_write
+
+    def rename_then_crash(path, data):
+        real_atomic_write(path, data)
+        raise OSError("crashed before the journal was truncated")
+
+    with monkeypatch.context() as m:
+        m.setattr(bot_main, "_atomic_write", rename_then_crash)
+        with pytest.raises(OSError):
+            asyncio.run(store.flush(snapshot=True))
+
+    assert (data_dir / "players.log").read_bytes() != b""
+    assert new_store().players == expected
+
+
+def test_snapshot_interval_rollover(data_dir):
+    store = new_store()
+    store.players["1"] = {"name": "a", "wins": 0}
+    store.mark_player("1")
+    asyncio.run(store.flush())
+
+    assert not (data_dir / "players.json").exists()
+    assert len((data_dir / "players.log").read_bytes().splitlines()) == 1
+
+    store._snapshot_at -= store.SNAPSHOT_INTERVAL
+    store.players["2"] = {"name": "b", "wins": 0}
+    store.mark_player("2")
+    asyncio.run(store.flush())
+
+    assert read_players(data_dir) == store.players
+    assert (data_dir / "players.log").read_bytes() == b""
+
+
+def test_failed_append_keeps_batch_and_forces_snapshot(data_dir, monkeypatch):
+    store = new_store()
+    store.players["1"] = {"name": "a", "wins": 0}
+    store.mark_player("1")
+
+    def full_disk(path, data):
+        raise OSError(28, "No space left on device")
+
+    with monkeypatch.context() as m:
+        m.setattr(bot_main, "append_journal", full_disk)
+        with pytest.raises(OSError):
+            asyncio.run(store.flush())
+
+    assert store._changed == {"1"}
+    asyncio.run(store.flush())
+    assert read_players(data_dir) == store.players
+    assert (data_dir / "players.log").read_bytes() == b""
+
+
+def test_partial_append_is_trimmed_before_the_next_write(data_dir, monkeypatch):
+    store = new_store()
+    store.players["1"] = {"name": "a", "wins": 0}
+    store.mark_player("1")
+    asyncio.run(store.flush())
+    journal = (data_dir / "players.log").read_bytes()
+
+    store.players["1"]["wins"] = 7
+    store.mark_player("1")
+    real_write = os.write
+
+    def half_then_full_disk(fd, data):
+        if bytes(data[:7]) == b'{"uid":':
+            real_write(fd, data[:len(data) // 2])
+            raise OSError(28, "No space left on device")
+        return real_write(fd, data)
+
+    with monkeypatch.context() as m:
+        m.setattr(os, "write", half_then_full_disk)
+        with pytest.raises(OSError):
+            asyncio.run(store.flush())
+
+    assert (data_dir / "players.log").read_bytes() == journal
+
+    # Crash in the forced snapshot before the rename: the journal alone
+    # must still replay to the latest state.
+    def crash(path, data):
+        raise OSError("crashed before os.replace")
+
+    with monkeypatch.context() as m:
+        m.setattr(bot_main, "_atomic_write", crash)
+        with pytest.raises(OSError):
+            asyncio.run(store.flush())
+
+    assert new_store().players == {"1": {"name": "a", "wins": 7}}
+
+
+def test_flush_loop_survives_write_error(data_dir, monkeypatch):
+    monkeypatch.setattr(bot_main.Store, "RETRY_INTERVAL", 0.05)
+    real_append = bot_main.append_journal
+    calls = []
+
+    def fail_once(path, data):
+        calls.append(path)
+        if len(calls) == 1:
+            raise OSError(28, "No space left on device")
+        real_append(path, data)
+
+    monkeypatch.setattr(bot_main, "append_journal", fail_once)
+
+    async def run():
+        store = bot_main.Store()
+        store.load()
+        flusher = asyncio.create_task(store._flush_loop())
+        store.players["1"] = {"name": "a", "wins": 0}
+        store.mark_player("1")
+        await asyncio.sleep(0.4)
+        store.players["2"] = {"name": "b", "wins": 0}
+        store.mark_player("2")
+        await asyncio.sleep(0.4)
+        store.close()
+        await flusher
+        return store
+
+    store = asyncio.run(run())
+
+    assert read_players(data_dir) == store.players == {
+        "1": {"name": "a", "wins": 0},
+        "2": {"name": "b", "wins": 0},
+    }
+
+
+def write_tournaments(data_dir, body, mtime_ns):
+    path = data_dir / "tournament.json"
+    path.write_bytes(body)
+    os.utime(path, ns=(mtime_ns, mtime_ns))
+
+
+ONE = b'{"tournaments": [{"name": "A", "buy_in": 5}]}'
+TWO = b'{"tournaments": [{"name": "B", "buy_in": 10}]}'
+
+
+def test_tournaments_reload_when_mtime_changes(data_dir):
+    write_tournaments(data_dir, ONE, 1_000_000_000)
+    store = new_store()
+    assert store.tournaments() == [{"name": "A", "buy_in": 5}]
+
+    write_tournaments(data_dir, TWO, 2_000_000_000)
+    assert store.tournaments() == [{"name": "B", "buy_in": 10}]
+
+
+def test_tournaments_keep_last_good_config_on_parse_error(data_dir):
+    write_tournaments(data_dir, ONE, 1_000_000_000)
+    store = new_store()
+
+    write_tournaments(data_dir, b'{"tournaments": [{"na', 2_000_000_000)
+    assert store.tournaments() == [{"name": "A", "buy_in": 5}]
+
+    # Same mtime as the failed read: it must be retried, not remembered.
+    write_tournaments(data_dir, TWO, 2_000_000_000)
+    assert store.tournaments() == [{"name": "B", "buy_in": 10}]
+
+
+def test_tournaments_missing_file(data_dir):
+    assert new_store().tournaments() == []
+
+
+def test_tournaments_unchanged_mtime_is_not_reread(data_dir, monkeypatch):
+    write_tournaments(data_dir, ONE, 1_000_000_000)
+    store = new_store()
+
+    reads = []
+    real_load_json = bot_main.load_json
+    monkeypatch.setattr(
+        bot_main, "load_json",
+        lambda path, default: reads.append(path) or real_load_json(path, default),
+    )
+    assert store.tournaments() == [{"name": "A", "buy_in": 5}]
+    assert reads == []